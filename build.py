@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import logging
 import json
 import pygit2
 import os
 import sys
 import tempfile
-from cookiecutter.main import cookiecutter
 
 from protobuilder import (
     ProtoRepoException,
@@ -17,11 +17,32 @@ from protobuilder import (
     gitutils,
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 _LOGGER = logging.getLogger(__name__)
 
 _RELATIVE_PATH_TO_SERVICES = 'service'
 _RELATIVE_PATH_TO_CONFIG = 'config.json'
 _RELATIVE_PATH_TO_TEMPLATES = 'lang'
+_DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'protorepo',
+)
+
+
+class _LazyJson(object):
+    """Defer pretty printing an object until a log record actually gets formatted"""
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        if orjson is not None:
+            return orjson.dumps(self.obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+        return json.dumps(self.obj, indent=2, sort_keys=True)
 
 
 def _setup_logging(verbosity=0):
@@ -45,12 +66,37 @@ def _setup_logging(verbosity=0):
     logging.basicConfig(stream=sys.stderr, level=loglevel, format=logging_format)
 
 
+def _positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: {!r}".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got {}".format(number))
+    return number
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate gRPC Stubs")
     parser.add_argument("--verbose", "-v", action='count', default=0, help="-v for info, -vv for debug")
     parser.add_argument("--service", "-s", action='store', help="Apply only to a specific service")
     parser.add_argument("--lang", "-l", action='store', help="Apply only to a specific service")
     parser.add_argument("--config", "-c", action='store', help="Default configuration file")
+    parser.add_argument(
+        "--cache-dir",
+        action='store',
+        default=_DEFAULT_CACHE_DIR,
+        help="Where to keep mirrors of the stub repos (default: %(default)s)",
+    )
+    parser.add_argument("--no-cache", action='store_true', help="Always clone stub repos from scratch")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        action='store',
+        type=_positive_int,
+        help="Maximum number of stub repos to build at once "
+        "(default: number of CPUs). Always capped by the docker daemon's CPU count",
+    )
 
     output = parser.add_mutually_exclusive_group(required=True)
     output.add_argument("--git", action="store_true", help="Make all changes to existing git repository")
@@ -61,12 +107,20 @@ def parse_args():
     return args
 
 
-def prepare_repo(job_config, repo_dir, templates_dir, update_git):
+def prepare_repo(job_config, output_dir, repo_dir, templates_dir, update_git, cache_dir=None):
+    # cookiecutter pulls in jinja2 and click, only import it once there is work to do
+    from cookiecutter.main import cookiecutter
+
     if update_git:
-        repo = pygit2.clone_repository(
-            '{}/{}'.format(job_config['github_org'], job_config['repo']),
-            repo_dir,
-        )
+        url = '{}/{}'.format(job_config['github_org'], job_config['repo'])
+        mirror = None
+        if cache_dir:
+            try:
+                mirror = gitutils.ensure_mirror(url, cache_dir)
+            except (gitutils.GitCommandError, OSError) as e:
+                # The cache is only an optimization, e.g. a read-only $HOME must not fail the build
+                _LOGGER.warning("Could not update the mirror of %s, cloning without it: %s", url, e)
+        repo = gitutils.fast_clone(url, repo_dir, reference=mirror)
     else:
         repo = pygit2.init_repository(repo_dir)
 
@@ -74,7 +128,7 @@ def prepare_repo(job_config, repo_dir, templates_dir, update_git):
 
     cookiecutter(
         os.path.join(templates_dir, "cookiecutter-{}".format(job_config['lang'])),
-        output_dir=os.path.split(repo_dir)[0],
+        output_dir=output_dir,
         extra_context=job_config,
         no_input=True,
         overwrite_if_exists=True,
@@ -121,17 +175,19 @@ def setup_branch(repo, git_data):
         _LOGGER.debug("Branch not found, creating %s", branch)
         repo.create_branch(branch, repo.get(last_commit.target))
 
-    repo.checkout(branch_ref)
+    # Only move HEAD; the working tree and index are rebuilt from generated code, not from the old tree
+    repo.set_head(branch_ref)
     return branch_ref, changes
 
 
-def update_repo(job_config, service_dir, output_dir, templates_dir, git_data, update_git=False):
+def update_repo(job_config, service_dir, output_dir, templates_dir, git_data, update_git=False, cache_dir=None):
     _LOGGER.info("Processing %s (%s): %s", job_config['service'], job_config['lang'], job_config['repo'])
-    _LOGGER.debug("Job data for %s:\n%s", job_config['repo'], json.dumps(job_config, indent=2, sort_keys=True))
+    _LOGGER.debug("Job data for %s:\n%s", job_config['repo'], _LazyJson(job_config))
 
     repo_dir = os.path.join(output_dir, job_config['repo'])
+    source_dir = os.path.join(repo_dir, job_config['source_dir'])
 
-    repo = prepare_repo(job_config, repo_dir, templates_dir, update_git)
+    repo = prepare_repo(job_config, output_dir, repo_dir, templates_dir, update_git, cache_dir)
 
     branch, newbranch = setup_branch(repo, git_data)
 
@@ -146,16 +202,15 @@ def update_repo(job_config, service_dir, output_dir, templates_dir, git_data, up
         repo.head.set_target(oid)
         _LOGGER.info("Initialized Repository %s at %s", job_config['repo'], oid.hex)
 
-    codegen.codegen(job_config, service_dir, os.path.join(repo_dir, job_config['source_dir']))
+    codegen.codegen(job_config, service_dir, source_dir)
     repo.index.add_all()
-    repo.index.write()
 
-    diff = repo.diff('HEAD', cached=True)
+    # Comparing tree ids is enough to spot changes, no need to build a diff
+    tree = repo.index.write_tree()
 
-    if len(diff):
+    if tree != repo.head.peel().tree_id:
         dirty_message = '[DIRTY] - ' if git_data['dirty'] else ''
 
-        tree = repo.index.write_tree()
         oid = repo.create_commit(
             branch,
             git_data['author'],
@@ -165,35 +220,113 @@ def update_repo(job_config, service_dir, output_dir, templates_dir, git_data, up
             [repo.head.target]
         )
         repo.head.set_target(oid)
+        repo.index.write()
         _LOGGER.info("Made Commit to Repository %s at %s", job_config['repo'], oid.hex)
-        push_objects.append(branch)
+        if branch not in push_objects:
+            push_objects.append(branch)
 
     for tag_data in git_data['tags']:
-        if tag_data.get('service') == job_config['service']:
+        if tag_data.get('service') != job_config['service']:
+            continue
+
+        tag_ref = 'refs/tags/{}'.format(tag_data['version'])
+        existing = repo.references.get(tag_ref)
+        if existing is not None:
             try:
-                tag_oid = repo.create_tag(
-                    tag_data['version'],
-                    repo.head.target,
-                    pygit2.GIT_OBJ_COMMIT,
-                    tag_data['tagger'],
-                    tag_data['message']
-                )
-                push_objects.append('refs/tags/{}'.format(tag_data['version']))
-                _LOGGER.info("Created tag %s (%s): %s", tag_data['version'], tag_oid, tag_data['message'].strip())
-            except ValueError:
+                tagged_id = existing.peel(pygit2.Commit).id
+            except (ValueError, pygit2.GitError):
+                # The tag points at a tree or blob, which is never ours
+                tagged_id = None
+            if tagged_id == repo.head.target:
+                _LOGGER.debug("Tag %s already exists on %s, skipping", tag_data['version'], job_config['repo'])
+            else:
                 _LOGGER.error(
                     "Tag %s, already exists on %s! This has to be remedied manually.",
                     tag_data['version'],
                     job_config['repo'],
                 )
+            continue
+
+        tag_oid = repo.create_tag(
+            tag_data['version'],
+            repo.head.target,
+            pygit2.GIT_OBJ_COMMIT,
+            tag_data['tagger'],
+            tag_data['message']
+        )
+        push_objects.append(tag_ref)
+        _LOGGER.info("Created tag %s (%s): %s", tag_data['version'], tag_oid, tag_data['message'].strip())
 
     if not push_objects:
         _LOGGER.debug("No changes for %s", job_config['repo'])
     elif update_git:
-        remote = repo.remotes['origin'].url
-        repo.remotes.set_push_url('origin', remote)
-        _LOGGER.info("Pushing changes to %s: %s", remote, push_objects)
-        repo.remotes['origin'].push(push_objects)
+        _LOGGER.info("Pushing changes to %s: %s", repo.remotes['origin'].url, push_objects)
+        gitutils.push(repo, push_objects)
+
+
+# Arguments shared by every job of a run, set once in each pool worker
+_job_context = {}
+
+
+def _init_worker(context, verbosity):
+    # Under spawn/forkserver the worker starts with no logging config of its own
+    _setup_logging(verbosity)
+    _job_context.update(context)
+
+
+def _run_job(job):
+    update_repo(job, **_job_context)
+
+
+def run_jobs(jobs, service_dir, output_dir, templates_dir, git_data, update_git=False, cache_dir=None, max_workers=None, verbosity=0):
+    """
+    Run update_repo for every job in a process pool, so the docker codegen
+    and git network traffic of independent repos overlap.
+
+    The arguments common to all jobs are handed to each worker once,
+    so only the job config itself is sent per task.
+
+    A failing job is logged and does not abort its peers.
+    Returns the number of jobs which failed.
+    """
+    if not jobs:
+        return 0
+
+    context = {
+        'service_dir': service_dir,
+        'output_dir': output_dir,
+        'templates_dir': templates_dir,
+        'git_data': git_data,
+        'update_git': update_git,
+        'cache_dir': cache_dir,
+    }
+
+    failures = 0
+    # Don't start more containers at once than the daemon has CPUs for
+    daemon_cpus = codegen.prepare_daemon()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    workers = min(len(jobs), max_workers, daemon_cpus or len(jobs))
+    _LOGGER.debug("Running %d jobs with %d workers", len(jobs), workers)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(context, verbosity),
+    ) as executor:
+        futures = {executor.submit(_run_job, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                future.result()
+            except ProtoRepoException as e:
+                _LOGGER.error("Failed processing %s (%s): %s", job['service'], job['lang'], e)
+                failures += 1
+            except Exception:
+                _LOGGER.exception("Failed processing %s (%s)", job['service'], job['lang'])
+                failures += 1
+
+    return failures
 
 
 def main():
@@ -211,7 +344,7 @@ def main():
     repodata = gitutils.analyze_head(repo)
     _LOGGER.debug(
         "Using git data from HEAD: %s",
-        json.dumps(gitutils.jsonify_git_data(repodata), indent=2, sort_keys=True),
+        _LazyJson(gitutils.jsonify_git_data(repodata)),
     )
 
     if not args.output:
@@ -229,24 +362,30 @@ def main():
 
         config_path = args.config if args.config else os.path.join(working_dir, _RELATIVE_PATH_TO_CONFIG)
         default_config = config.load_default_config(config_path)
-        for service in os.listdir(service_dir):
+        for service in config.list_services(service_dir):
             service_configs = config.load_service_config(service, default_config, service_dir)
             manifest.extend(service_configs)
+        jobs = []
         for job in manifest:
             if args.lang and args.lang != job['lang']:
                 continue
             if args.service and args.service != job['service']:
                 continue
-
-            update_repo(
-                job,
-                service_dir,
-                output_dir,
-                os.path.join(working_dir, _RELATIVE_PATH_TO_TEMPLATES),
-                repodata,
-                update_git=args.git,
-            )
-
+            jobs.append(job)
+
+        failures = run_jobs(
+            jobs,
+            service_dir,
+            output_dir,
+            os.path.join(working_dir, _RELATIVE_PATH_TO_TEMPLATES),
+            repodata,
+            update_git=args.git,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            max_workers=args.jobs,
+            verbosity=args.verbose,
+        )
+        if failures:
+            raise ProtoRepoException("{} of {} jobs failed".format(failures, len(jobs)))
 
     except ProtoRepoException as e:
         _LOGGER.error(e)
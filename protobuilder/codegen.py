@@ -1,21 +1,107 @@
 import os
-import docker
 import logging
 
+from protobuilder import ProtoRepoException
+
 _LOGGER = logging.getLogger(__name__)
 
+_IMAGE = 'scottschroeder/protoc-all:1.11'  # TODO Image src
+
+
+class CodegenError(ProtoRepoException):
+    """The protoc container exited unsuccessfully"""
+
+
+_docker_client = None
+_docker_client_pid = None
+
+
+def _get_docker():
+    """
+    Lazily create one docker client per process and reuse it for every job that process runs.
+    The client's HTTP session must not be shared across a fork,
+    so a client inherited from a parent process is never reused.
+    """
+    global _docker_client, _docker_client_pid
+    if _docker_client is None or _docker_client_pid != os.getpid():
+        import docker
+        _docker_client = docker.from_env()
+        _docker_client_pid = os.getpid()
+    return _docker_client
+
+
+def prepare_daemon():
+    """
+    Make sure the protoc image is present once up front, rather than having every job race to pull it.
+    Returns the number of CPUs available to the docker daemon, or None if it can't be asked.
+
+    This uses a short lived client of its own, the jobs all run in worker processes.
+    """
+    import docker
+    import requests
 
-def codegen(config, services_dir, output_dir):
     client = docker.from_env()
+    try:
+        try:
+            client.images.get(_IMAGE)
+        except docker.errors.ImageNotFound:
+            try:
+                client.images.pull(_IMAGE)
+            except docker.errors.APIError as e:
+                _LOGGER.warning("Could not pull %s, leaving it to each job: %s", _IMAGE, e)
+        return client.info().get('NCPU')
+    except (docker.errors.APIError, requests.exceptions.ConnectionError) as e:
+        # Let each job report the problem instead of failing the whole run here
+        _LOGGER.warning("Could not prepare the docker daemon: %s", e)
+        return None
+    finally:
+        client.api.close()
+
+
+def _iter_lines(chunks):
+    """
+    Split a stream of byte chunks into decoded lines.
+    Chunks can end mid line, or even mid character, so only whole lines are decoded.
+    """
+    pending = b''
+    for chunk in chunks:
+        lines = chunk.split(b'\n')
+        lines[0] = pending + lines[0]
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode(errors='replace').rstrip()
+    if pending:
+        yield pending.decode(errors='replace').rstrip()
+
+
+def codegen(config, services_dir, output_dir):
+    client = _get_docker()
     os.makedirs(output_dir, 0o755, exist_ok=True)
     volumes = {
         services_dir: {'bind': '/defs', 'mode': 'rw'},
         output_dir: {'bind': '/out', 'mode': 'rw'},
     }
-    c = client.containers.run(
-        image='scottschroeder/protoc-all:1.11',  # TODO Image src
+    container = client.containers.run(
+        image=_IMAGE,
         command=['-d', config['service'], '-l', config['lang'], '-o', '/out'],
         volumes=volumes,
-        auto_remove=True,
+        detach=True,
     )
-    _LOGGER.debug("Build Results: %s", c)
+
+    # Stream the output while protoc runs instead of blocking on a buffered result
+    output = []
+    try:
+        for line in _iter_lines(container.logs(stream=True, follow=True)):
+            output.append(line)
+            _LOGGER.debug("Build output (%s): %s", config['repo'], line)
+        result = container.wait()
+    finally:
+        container.remove(force=True)
+
+    if result['StatusCode'] != 0:
+        raise CodegenError("Codegen for {} ({}) exited with status {}:\n{}".format(
+            config['service'],
+            config['lang'],
+            result['StatusCode'],
+            '\n'.join(output),
+        ))
@@ -1,11 +1,16 @@
+import functools
 import json
 import os
-import copy
 
 import jsonschema
 
 from protobuilder import ProtoRepoException
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class BadConfig(ProtoRepoException):
     """A config was not in the right format"""
@@ -33,11 +38,49 @@ _FULL_CONFIG_SCHEMA = {
 }
 
 
-def load_default_config(path):
+def _compile_schema(schema):
+    jsonschema.Draft4Validator.check_schema(schema)
+    return jsonschema.Draft4Validator(schema)
+
+
+# Build validators once; jsonschema.validate re-checks the schema on every call
+_DEFAULT_VALIDATOR = _compile_schema(_DEFAULT_CONFIG_SCHEMA)
+_SERVICE_VALIDATOR = _compile_schema(_SERVICE_CONFIG_SCHEMA)
+_FULL_VALIDATOR = _compile_schema(_FULL_CONFIG_SCHEMA)
+
+# Full configs which already passed validation, as canonical JSON
+_VALID_FULL_CONFIGS = set()
+
+
+def _load_json(path):
+    """Parse a JSON file, with orjson if it is installed"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
     with open(path) as f:
-        data = json.load(f)
-        jsonschema.validate(data, _DEFAULT_CONFIG_SCHEMA)
-        return data
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=16)
+def load_default_config(path):
+    data = _load_json(path)
+    _DEFAULT_VALIDATOR.validate(data)
+    return data
+
+
+@functools.lru_cache(maxsize=None)
+def list_services(services_dir):
+    """Names of the service directories, in sorted order, read once per process"""
+    with os.scandir(services_dir) as entries:
+        return tuple(sorted(entry.name for entry in entries if entry.is_dir()))
+
+
+def _validate_full_config(full_config):
+    """Services often share identical lang configs, only validate each one once"""
+    key = json.dumps(full_config, sort_keys=True)
+    if key not in _VALID_FULL_CONFIGS:
+        _FULL_VALIDATOR.validate(full_config)
+        _VALID_FULL_CONFIGS.add(key)
 
 
 def generated_source_dir(lang, service):
@@ -49,21 +92,30 @@ def generated_source_dir(lang, service):
         raise ProtoRepoException("Tried to figure out source for unknown lang: {}".format(lang))
 
 
+@functools.lru_cache(maxsize=None)
+def _read_service_config(path, mtime_ns):
+    """
+    Parse and validate a service config file.
+    The mtime is part of the cache key, so an edited file is read again.
+    """
+    data = _load_json(path)
+    _SERVICE_VALIDATOR.validate(data)
+    return data
+
+
 def load_service_config(service, default_config, services_dir):
     path = os.path.join(services_dir, service, _SERVICE_CONFIG_NAME)
     try:
-        with open(path) as f:
-            service_all_langs_config = json.load(f)
+        mtime_ns = os.stat(path).st_mtime_ns
     except FileNotFoundError:
         raise BadConfig("Must define a config file for each service, missing: {}".format(path))
 
-    jsonschema.validate(service_all_langs_config, _SERVICE_CONFIG_SCHEMA)
+    service_all_langs_config = _read_service_config(path, mtime_ns)
 
     config = []
     for service_lang_config in service_all_langs_config:
-        full_config = copy.deepcopy(default_config)
-        full_config.update(service_lang_config)
-        jsonschema.validate(full_config, _FULL_CONFIG_SCHEMA)
+        full_config = {**default_config, **service_lang_config}
+        _validate_full_config(full_config)
 
         if 'repo' not in full_config:
             full_config.update({'repo': 'proto-{}-{}'.format(service, full_config['lang'])})
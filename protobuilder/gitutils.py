@@ -1,14 +1,111 @@
+import copyreg
 import pygit2
 import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import urllib.parse
+
+from protobuilder import ProtoRepoException
 
 _LOGGER = logging.getLogger(__name__)
 
+_TAGS_PREFIX = 'refs/tags/'
+_TAGS_PREFIX_LEN = len(_TAGS_PREFIX)
+
+# Only branches and tags are needed, a plain --mirror would also pull refs/pull/* and friends
+_MIRROR_REFSPECS = ('+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+
+
+class GitCommandError(ProtoRepoException):
+    """A git command line invocation failed"""
+
+
+def _make_signature(name, email, time, offset, encoding):
+    return pygit2.Signature(name, email, time, offset, encoding)
+
+
+def _pickle_signature(signature):
+    # pickle can't reference the Signature type itself, it lives in the C extension module
+    return _make_signature, (signature.name, signature.email, signature.time, signature.offset, signature._encoding)
+
+
+# The git data from analyze_head is handed to worker processes, which needs signatures to pickle
+copyreg.pickle(pygit2.Signature, _pickle_signature)
+
 
 def get_repo_from_path(path):
     repository_path = pygit2.discover_repository(path)
     return pygit2.Repository(repository_path)
 
 
+def _git(*args):
+    command = ['git'] + list(args)
+    _LOGGER.debug("Running: %s", ' '.join(command))
+    # Several pool workers may run git at once, never let them prompt for credentials on the tty
+    result = subprocess.run(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=dict(os.environ, GIT_TERMINAL_PROMPT='0'),
+    )
+    if result.returncode != 0:
+        raise GitCommandError("'{}' failed: {}".format(
+            ' '.join(command),
+            result.stderr.decode(errors='replace').strip(),
+        ))
+    return result
+
+
+def ensure_mirror(url, cache_dir):
+    """
+    Keep a bare mirror of url under cache_dir, so later clones only need to
+    fetch new objects over the network. Returns the path to the mirror.
+    """
+    mirror_dir = os.path.join(cache_dir, '{}.git'.format(urllib.parse.quote(url, safe='')))
+    if os.path.isdir(mirror_dir):
+        _git('-C', mirror_dir, 'fetch', '--prune', 'origin', *_MIRROR_REFSPECS)
+        return mirror_dir
+
+    os.makedirs(cache_dir, 0o755, exist_ok=True)
+    # Clone next to the final location and move it into place once complete,
+    # so a failed or concurrent clone never leaves a half written mirror behind
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        _git('clone', '--bare', url, tmp_dir)
+        os.rename(tmp_dir, mirror_dir)
+    except OSError:
+        if not os.path.isdir(mirror_dir):
+            raise
+        _LOGGER.debug("Mirror of %s was created by another build, using it", url)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return mirror_dir
+
+
+def fast_clone(url, repo_dir, reference=None):
+    """
+    Clone with the git CLI, which is much faster than libgit2 for this.
+
+    Without a reference repository the clone is shallow, but all remote branches
+    are still fetched (at depth 1) so we can switch to them. With one, objects are
+    borrowed from the local reference instead of being transferred at all.
+
+    Nothing is checked out, the stub repo contents get regenerated from scratch anyway.
+    """
+    if reference:
+        _git('clone', '--no-checkout', '--reference', reference, url, repo_dir)
+    else:
+        _git('clone', '--no-checkout', '--depth=1', '--no-single-branch', url, repo_dir)
+    return pygit2.Repository(repo_dir)
+
+
+def push(repo, refs):
+    _git('-C', repo.workdir, 'push', 'origin', *refs)
+
+
 def repo_data(repo):
     """
     This is a helper utility that doesn't get used by the main execution
@@ -22,22 +119,25 @@ def repo_data(repo):
     for objhex in repo:
         obj = repo[objhex]
         if obj.type == pygit2.GIT_OBJ_COMMIT:
+            author = obj.author
             objects['commits'].append({
                 'hash': obj.hex,
                 'message': obj.message,
                 'commit_date': obj.commit_time,
-                'author_name': obj.author.name,
-                'author_email': obj.author.email,
-                'parents': [c.hex for c in obj.parents],
+                'author_name': author.name,
+                'author_email': author.email,
+                # parent_ids comes from the commit header, parents would load every parent commit
+                'parents': [str(oid) for oid in obj.parent_ids],
             })
         elif obj.type == pygit2.GIT_OBJ_TAG:
+            tagger = obj.tagger
             objects['tags'].append({
                 'hex': obj.hex,
                 'name': obj.name,
                 'message': obj.message,
                 'target': str(obj.target),
-                'tagger_name': obj.tagger.name,
-                'tagger_email': obj.tagger.email,
+                'tagger_name': tagger.name,
+                'tagger_email': tagger.email,
             })
         else:
             # ignore blobs and trees
@@ -62,7 +162,15 @@ def jsonify_git_data(data):
     return pretty
 
 
-def analyze_head(repo):
+def analyze_head(repo, tag_index=None):
+    """
+    Gather the git data used to build stub repos from the HEAD of repo.
+    tag_index (from build_tag_index) can be passed in when analyzing several commits.
+    """
+    if tag_index is None:
+        # Most commits aren't tagged, don't resolve every tag in the repo just to find that out
+        tag_index = build_tag_index(repo) if is_head_tagged(repo) else {}
+
     data = {
         'committer': repo.default_signature,
     }
@@ -81,38 +189,58 @@ def analyze_head(repo):
     data['dirty'] = check_dirty(repo)
 
     data['tags'] = [
-        analyze_tag(repo, tagref)
-        for tagref in get_all_tags(repo, repo.head.target)
+        analyze_tag(repo, reference.name, default_tagger=data['author'], reference=reference)
+        for reference in tag_index.get(repo.head.target, [])
     ]
 
     return data
 
 
-def check_dirty(repo):
-    working = repo.diff()
-    last_commit = repo.diff('HEAD')
-    staged = repo.diff('HEAD', cached=True)
-
-    if len(staged) + len(working) + len(last_commit):
-        return True
-    else:
+def is_head_tagged(repo):
+    """
+    True if any tag, lightweight or annotated, points exactly at HEAD.
+    libgit2's describe does the search without loading every tag into Python.
+    """
+    try:
+        repo.describe(repo.head, describe_strategy=pygit2.GIT_DESCRIBE_TAGS, max_candidates_tags=0)
+    except KeyError:
+        # No tag matches HEAD exactly
         return False
+    except pygit2.GitError as e:
+        # Raised when the repo has no tags at all, but also on any other libgit2 failure.
+        # Don't risk dropping HEAD's tags, scanning the tags ourselves is cheap when there are none.
+        _LOGGER.debug("describe failed, falling back to a full tag scan: %s", e)
+    return True
 
 
-def analyze_tag(repo, tagref):
+def check_dirty(repo):
+    """
+    True if tracked files have staged or unstaged changes.
+    Untracked and ignored files don't count, matching what diffing against HEAD reported.
+    """
+    ignored_flags = pygit2.GIT_STATUS_WT_NEW | pygit2.GIT_STATUS_IGNORED
+    return any(flags & ~ignored_flags for flags in repo.status().values())
+
+
+def analyze_tag(repo, tagref, default_tagger=None, reference=None):
     """
     Return a dictionary containing protorepo relevant data from a specific tagref
     e.g. 'refs/tags/helloworld/1.0.0'
+
+    Lightweight tags have no tagger, so default_tagger is used for them
+    (the author of HEAD if not given).
+    Pass the already resolved reference for tagref, if there is one, to avoid looking it up again.
     """
 
-    try:
-        tagname = tagref.split('refs/tags/')[1]
-    except IndexError:
+    if not tagref.startswith(_TAGS_PREFIX):
         raise ValueError("tagref '{}' was not of the form 'refs/tags/mytag'".format(tagref))
+    tagname = tagref[_TAGS_PREFIX_LEN:]
 
     _LOGGER.debug("Processing tag: %s", tagname)
 
-    tagobj = repo.get(repo.lookup_reference(tagref).target)
+    if reference is None:
+        reference = repo.lookup_reference(tagref)
+    tagobj = repo.get(reference.target)
 
     if isinstance(tagobj, pygit2.Tag):
         _LOGGER.debug("Tag object %s is an annotated tag", tagobj)
@@ -120,7 +248,7 @@ def analyze_tag(repo, tagref):
         message = tagobj.message
     else:
         _LOGGER.debug("Tag object %s is a lightweight tag, using commit data", tagobj)
-        tagger = repo.get(repo.head.target).author
+        tagger = default_tagger if default_tagger is not None else repo.get(repo.head.target).author
         message = "{}\n".format(tagname)
 
     data = {
@@ -130,33 +258,47 @@ def analyze_tag(repo, tagref):
         'message': message,
     }
 
-    tag_parts = tagname.split('/')
-    if len(tag_parts) == 2:
-        data['service'] = tag_parts[0]
-        data['version'] = tag_parts[1]
+    service, sep, version = tagname.partition('/')
+    if sep and '/' not in version:
+        data['service'] = service
+        data['version'] = version
 
     return data
 
 
-def get_all_tags(repo, target):
+def build_tag_index(repo):
     """
-    All the possible tags which describe a particular commit
-    get_all_tags(repo, repo.head.target) -> ['refs/tags/1.0.0.beta', 'refs/tags/1.0.0']
+    Map commit ids to the references of all the tags which describe them,
+    in a single pass over the refs
+    build_tag_index(repo)[repo.head.target] -> [<Reference refs/tags/1.0.0.beta>, <Reference refs/tags/1.0.0>]
     """
-    return [
-        ref
-        for ref in repo.listall_references()
-        if ref.startswith('refs/tags/') and get_target_from_tagref(repo, ref) == target
-    ]
+    index = {}
+    for reference in _iter_tag_references(repo):
+        try:
+            # peel resolves both lightweight and annotated tags to a commit in one call
+            commit_id = reference.peel(pygit2.Commit).id
+        except (ValueError, pygit2.GitError):
+            _LOGGER.debug("Tag %s does not point to a commit, ignoring", reference.name)
+            continue
+        index.setdefault(commit_id, []).append(reference)
+    return index
+
+
+def _iter_tag_references(repo):
+    """
+    Every tag in repo as a Reference object.
+    Newer pygit2 filters tags while iterating, otherwise all references are
+    loaded as objects in a single call and filtered by name.
+    """
+    tags_filter = getattr(pygit2, 'GIT_REFERENCES_TAGS', None)
+    if tags_filter is not None:
+        return repo.references.iterator(tags_filter)
+    return (ref for ref in repo.listall_reference_objects() if ref.name.startswith(_TAGS_PREFIX))
 
 
-def get_target_from_tagref(repo, tagref):
+def get_all_tags(repo, target):
     """
-    Resolve both lightweight and annotated tags to a commit target
+    All the possible tags which describe a particular commit
+    get_all_tags(repo, repo.head.target) -> ['refs/tags/1.0.0.beta', 'refs/tags/1.0.0']
     """
-    target = repo.lookup_reference(tagref).target
-    tagobj = repo.get(target)
-    if isinstance(tagobj, pygit2.Tag):
-        return tagobj.target
-    else:
-        return target
+    return [reference.name for reference in build_tag_index(repo).get(target, [])]